@@ -1,32 +1,109 @@
 from flask import Flask
-from dash import Dash, html, dcc, Input, Output, State
+from dash import Dash, html, dcc, Input, Output, State, ClientsideFunction
 import dash_bootstrap_components as dbc
 from datetime import datetime, timedelta
-import pandas as pd
-import plotly.graph_objects as go
+import numpy as np
+import plotly.io as pio
 from plotly.subplots import make_subplots
 import redis
 from pymongo import MongoClient
 import os
+import json
+import time
+import functools
+import logging
+import threading
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Initialize Flask app
 server = Flask(__name__)
 
-# Initialize Redis for real-time data
-redis_client = redis.Redis(
+# Initialize Redis for real-time data, sharing one pool across callbacks
+# (callbacks wait for a free connection rather than failing under load)
+redis_pool = redis.BlockingConnectionPool(
     host=os.getenv('REDIS_HOST', 'localhost'),
     port=int(os.getenv('REDIS_PORT', 6379)),
-    db=0
+    db=0,
+    max_connections=50
 )
+redis_client = redis.Redis(connection_pool=redis_pool)
 
 # Initialize MongoDB for historical data
-mongo_client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'))
+mongo_client = MongoClient(
+    os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'),
+    maxPoolSize=50,
+    minPoolSize=5,
+    compressors='zstd,zlib'
+)
 db = mongo_client['chatbot_analytics']
 
+# Maximum points returned for the cost and rate limit charts
+CHART_POINTS = 300
+
+# Latest real-time stats, pushed by the collector over Redis Pub/Sub
+STATS_CHANNEL = 'chatbot_dashboard:stats'
+STATS_KEYS = ['total_messages', 'active_users', 'api_cost', 'rate_limit']
+latest_stats = {}
+latest_stats_lock = threading.Lock()
+
+def load_stats():
+    # Seed the cache from Redis in a single round-trip
+    values = redis_client.mget(STATS_KEYS)
+    with latest_stats_lock:
+        latest_stats.update(
+            {key: value for key, value in zip(STATS_KEYS, values) if value is not None}
+        )
+
+def listen_for_stats():
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(STATS_CHANNEL)
+            # Seed after subscribing so no update published in between is lost
+            load_stats()
+            for message in pubsub.listen():
+                try:
+                    stats = json.loads(message['data'])
+                    stats = {key: stats[key] for key in STATS_KEYS if key in stats}
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"Ignoring malformed stats message: {e}")
+                    continue
+                with latest_stats_lock:
+                    latest_stats.update(stats)
+        except redis.RedisError as e:
+            logger.error(f"Error in stats subscriber: {e}")
+            time.sleep(5)
+
+threading.Thread(target=listen_for_stats, daemon=True).start()
+
+def redis_memoize(ttl):
+    # Share each chart's data across all connected dashboards for one ttl-second window
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            key = f'chart:{fn.__name__}:{int(time.time()) // ttl}'
+            try:
+                cached = redis_client.get(key)
+            except redis.RedisError as e:
+                # The cache is optional; charts still render straight from MongoDB
+                logger.error(f"Error reading chart cache: {e}")
+                return fn(*args)
+            if cached is not None:
+                return json.loads(cached)
+            data = fn(*args)
+            try:
+                redis_client.setex(key, ttl, pio.json.to_json_plotly(data))
+            except redis.RedisError as e:
+                logger.error(f"Error writing chart cache: {e}")
+            return data
+        return wrapper
+    return decorator
+
 # Initialize Dash app with dark theme
 app = Dash(
     __name__,
@@ -153,6 +230,15 @@ app.layout = dbc.Container([
         ], width=12)
     ]),
     
+    # Chart data, rendered into figures by the clientside callbacks
+    dcc.Store(id='message-volume-data'),
+    dcc.Store(id='cost-data'),
+    dcc.Store(id='rate-limit-data'),
+    dcc.Store(id='activity-heatmap-data'),
+    
+    # Plotly template shared by all charts, sent once with the layout
+    dcc.Store(id='chart-template', data=pio.templates['plotly_dark'].to_plotly_json()),
+    
     # Update interval
     dcc.Interval(
         id='interval-component',
@@ -175,11 +261,13 @@ app.css.append_css({
     [Input('interval-component', 'n_intervals')]
 )
 def update_stats(n):
-    # Get real-time stats from Redis
-    total_messages = redis_client.get('total_messages') or 0
-    active_users = redis_client.get('active_users') or 0
-    api_cost = redis_client.get('api_cost') or 0
-    rate_limit = redis_client.get('rate_limit') or 100
+    # Read the latest stats pushed by the collector
+    with latest_stats_lock:
+        stats = dict(latest_stats)
+    total_messages = stats.get('total_messages', 0)
+    active_users = stats.get('active_users', 0)
+    api_cost = stats.get('api_cost', 0)
+    rate_limit = stats.get('rate_limit', 100)
     
     return [
         f"{int(total_messages):,}",
@@ -189,15 +277,36 @@ def update_stats(n):
     ]
 
 @app.callback(
-    Output('message-volume-chart', 'figure'),
+    Output('message-volume-data', 'data'),
     [Input('interval-component', 'n_intervals')]
 )
+@redis_memoize(ttl=5)
 def update_message_volume(n):
-    # Get historical data from MongoDB
-    collection = db['message_logs']
+    # Get per-minute message rollups from MongoDB
+    start_time = datetime.now() - timedelta(hours=24)
+    results = list(db.stats_minute.find(
+        {'t': {'$gte': start_time}},
+        {'_id': 0, 't': 1, 'count': 1}
+    ).sort('t', 1))
+    
+    # Unpack into numpy arrays for plotting
+    timestamps = np.fromiter((r['t'] for r in results), dtype='datetime64[ms]', count=len(results))
+    counts = np.fromiter((r['count'] for r in results), dtype=np.int64, count=len(results))
+    
+    return {'x': timestamps, 'y': counts}
+
+@app.callback(
+    Output('cost-data', 'data'),
+    [Input('interval-component', 'n_intervals')]
+)
+@redis_memoize(ttl=5)
+def update_cost_chart(n):
+    # Get cost data from MongoDB
+    collection = db['api_costs']
     end_time = datetime.now()
     start_time = end_time - timedelta(hours=24)
     
+    # Downsample to evenly filled time buckets, averaging each one
     pipeline = [
         {
             '$match': {
@@ -208,166 +317,37 @@ def update_message_volume(n):
             }
         },
         {
-            '$group': {
-                '_id': {
-                    '$dateToString': {
-                        'format': '%Y-%m-%d %H:00',
-                        'date': '$timestamp'
-                    }
-                },
-                'count': {'$sum': 1}
+            '$bucketAuto': {
+                'groupBy': '$timestamp',
+                'buckets': CHART_POINTS,
+                'output': {'cost': {'$avg': '$cost'}}
             }
         },
         {
-            '$sort': {'_id': 1}
+            '$project': {'timestamp': '$_id.min', 'cost': 1, '_id': 0}
         }
     ]
     
     results = list(collection.aggregate(pipeline))
     
-    # Create DataFrame
-    df = pd.DataFrame(results)
-    if not df.empty:
-        df['_id'] = pd.to_datetime(df['_id'])
-        df = df.set_index('_id')
-    
-    # Create figure with modern styling
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=df.index,
-        y=df['count'],
-        mode='lines+markers',
-        name='Messages',
-        line=dict(color='#00ff9d', width=3),
-        marker=dict(size=8, color='#00ff9d'),
-        fill='tozeroy',
-        fillcolor='rgba(0, 255, 157, 0.1)'
-    ))
-    
-    fig.update_layout(
-        title='Message Volume Over Time',
-        xaxis_title='Time',
-        yaxis_title='Number of Messages',
-        hovermode='x unified',
-        template='plotly_dark',
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        font=dict(color='white'),
-        margin=dict(l=40, r=40, t=40, b=40)
-    )
+    # Unpack into numpy arrays for plotting
+    timestamps = np.fromiter((r['timestamp'] for r in results), dtype='datetime64[ms]', count=len(results))
+    values = np.fromiter((r['cost'] for r in results), dtype=np.float64, count=len(results))
     
-    return fig
+    return {'x': timestamps, 'y': values}
 
 @app.callback(
-    Output('cost-chart', 'figure'),
-    [Input('interval-component', 'n_intervals')]
-)
-def update_cost_chart(n):
-    # Get cost data from MongoDB
-    collection = db['api_costs']
-    end_time = datetime.now()
-    start_time = end_time - timedelta(hours=24)
-    
-    results = list(collection.find({
-        'timestamp': {
-            '$gte': start_time,
-            '$lte': end_time
-        }
-    }).sort('timestamp', 1))
-    
-    # Create DataFrame
-    df = pd.DataFrame(results)
-    if not df.empty:
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df = df.set_index('timestamp')
-    
-    # Create figure with modern styling
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=df.index,
-        y=df['cost'],
-        mode='lines+markers',
-        name='API Cost',
-        line=dict(color='#ff6b6b', width=3),
-        marker=dict(size=8, color='#ff6b6b'),
-        fill='tozeroy',
-        fillcolor='rgba(255, 107, 107, 0.1)'
-    ))
-    
-    fig.update_layout(
-        title='API Cost Over Time',
-        xaxis_title='Time',
-        yaxis_title='Cost ($)',
-        hovermode='x unified',
-        template='plotly_dark',
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        font=dict(color='white'),
-        margin=dict(l=40, r=40, t=40, b=40)
-    )
-    
-    return fig
-
-@app.callback(
-    Output('rate-limit-chart', 'figure'),
+    Output('rate-limit-data', 'data'),
     [Input('interval-component', 'n_intervals')]
 )
+@redis_memoize(ttl=5)
 def update_rate_limit_chart(n):
     # Get rate limit data from MongoDB
     collection = db['rate_limits']
     end_time = datetime.now()
     start_time = end_time - timedelta(hours=24)
     
-    results = list(collection.find({
-        'timestamp': {
-            '$gte': start_time,
-            '$lte': end_time
-        }
-    }).sort('timestamp', 1))
-    
-    # Create DataFrame
-    df = pd.DataFrame(results)
-    if not df.empty:
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df = df.set_index('timestamp')
-    
-    # Create figure with modern styling
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=df.index,
-        y=df['remaining'],
-        mode='lines+markers',
-        name='Remaining Quota',
-        line=dict(color='#4cc9f0', width=3),
-        marker=dict(size=8, color='#4cc9f0'),
-        fill='tozeroy',
-        fillcolor='rgba(76, 201, 240, 0.1)'
-    ))
-    
-    fig.update_layout(
-        title='Rate Limit Usage',
-        xaxis_title='Time',
-        yaxis_title='Remaining Quota (%)',
-        hovermode='x unified',
-        template='plotly_dark',
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        font=dict(color='white'),
-        margin=dict(l=40, r=40, t=40, b=40)
-    )
-    
-    return fig
-
-@app.callback(
-    Output('activity-heatmap', 'figure'),
-    [Input('interval-component', 'n_intervals')]
-)
-def update_activity_heatmap(n):
-    # Get user activity data from MongoDB
-    collection = db['user_activity']
-    end_time = datetime.now()
-    start_time = end_time - timedelta(hours=24)
-    
+    # Downsample to evenly filled time buckets, averaging each one
     pipeline = [
         {
             '$match': {
@@ -378,47 +358,57 @@ def update_activity_heatmap(n):
             }
         },
         {
-            '$group': {
-                '_id': {
-                    'hour': {'$hour': '$timestamp'},
-                    'day': {'$dayOfWeek': '$timestamp'}
-                },
-                'count': {'$sum': 1}
+            '$bucketAuto': {
+                'groupBy': '$timestamp',
+                'buckets': CHART_POINTS,
+                'output': {'remaining': {'$avg': '$remaining'}}
             }
+        },
+        {
+            '$project': {'timestamp': '$_id.min', 'remaining': 1, '_id': 0}
         }
     ]
     
     results = list(collection.aggregate(pipeline))
     
-    # Create DataFrame
-    df = pd.DataFrame(results)
-    if not df.empty:
-        df['hour'] = df['_id'].apply(lambda x: x['hour'])
-        df['day'] = df['_id'].apply(lambda x: x['day'])
-        df = df.pivot(index='hour', columns='day', values='count')
-        df = df.fillna(0)
+    # Unpack into numpy arrays for plotting
+    timestamps = np.fromiter((r['timestamp'] for r in results), dtype='datetime64[ms]', count=len(results))
+    values = np.fromiter((r['remaining'] for r in results), dtype=np.float64, count=len(results))
     
-    # Create heatmap with modern styling
-    fig = go.Figure(data=go.Heatmap(
-        z=df.values,
-        x=['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
-        y=[f"{h:02d}:00" for h in range(24)],
-        colorscale='Viridis',
-        showscale=True
+    return {'x': timestamps, 'y': values}
+
+@app.callback(
+    Output('activity-heatmap-data', 'data'),
+    [Input('interval-component', 'n_intervals')]
+)
+@redis_memoize(ttl=5)
+def update_activity_heatmap(n):
+    # Get pre-aggregated user activity from MongoDB
+    start_time = datetime.now() - timedelta(hours=24)
+    results = list(db.heatmap_counts.find(
+        {'hour_start': {'$gte': start_time}},
+        {'_id': 0, 'h': 1, 'd': 1, 'count': 1}
     ))
     
-    fig.update_layout(
-        title='User Activity Heatmap',
-        xaxis_title='Day of Week',
-        yaxis_title='Hour of Day',
-        template='plotly_dark',
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        font=dict(color='white'),
-        margin=dict(l=40, r=40, t=40, b=40)
-    )
+    # Fill the hour x day grid (days are ISO weekdays, Mon=1)
+    z = np.zeros((24, 7))
+    z[[r['h'] for r in results], [r['d'] - 1 for r in results]] = [r['count'] for r in results]
     
-    return fig
+    return {'z': z}
+
+# Assemble the chart figures in the browser from the stored data
+for function_name, graph_id, store_id in [
+    ('renderMessageVolume', 'message-volume-chart', 'message-volume-data'),
+    ('renderCost', 'cost-chart', 'cost-data'),
+    ('renderRateLimit', 'rate-limit-chart', 'rate-limit-data'),
+    ('renderActivityHeatmap', 'activity-heatmap', 'activity-heatmap-data')
+]:
+    app.clientside_callback(
+        ClientsideFunction(namespace='charts', function_name=function_name),
+        Output(graph_id, 'figure'),
+        [Input(store_id, 'data')],
+        [State('chart-template', 'data')]
+    )
 
 if __name__ == '__main__':
     print("Dashboard is running at http://localhost:8051")
@@ -0,0 +1,97 @@
+// Builds the dashboard figures in the browser. The server only sends the
+// series data for each chart; all styling is applied here.
+
+var DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'];
+var HOURS = [];
+for (var h = 0; h < 24; h++) {
+    HOURS.push((h < 10 ? '0' : '') + h + ':00');
+}
+
+// Build a fresh layout on every update: plotly.js writes range and autorange
+// back into the layout it is given, so a shared object would pin the view
+function chartLayout(template, title, xaxisTitle, yaxisTitle, options) {
+    return Object.assign({
+        title: {text: title},
+        xaxis: {title: {text: xaxisTitle}},
+        yaxis: {title: {text: yaxisTitle}},
+        template: template,
+        paper_bgcolor: 'rgba(0,0,0,0)',
+        plot_bgcolor: 'rgba(0,0,0,0)',
+        font: {color: 'white'},
+        margin: {l: 40, r: 40, t: 40, b: 40}
+    }, options);
+}
+
+function lineFigure(data, template, options) {
+    if (!data) {
+        return window.dash_clientside.no_update;
+    }
+
+    return {
+        data: [{
+            type: 'scatter',
+            x: data.x,
+            y: data.y,
+            mode: 'lines',
+            name: options.name,
+            line: {color: options.color, width: 3},
+            fill: 'tozeroy',
+            fillcolor: options.fillcolor
+        }],
+        layout: chartLayout(template, options.title, 'Time', options.yaxisTitle, {
+            hovermode: 'x unified'
+        })
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    charts: {
+        renderMessageVolume: function(data, template) {
+            return lineFigure(data, template, {
+                title: 'Message Volume Over Time',
+                yaxisTitle: 'Number of Messages',
+                name: 'Messages',
+                color: '#00ff9d',
+                fillcolor: 'rgba(0, 255, 157, 0.1)'
+            });
+        },
+
+        renderCost: function(data, template) {
+            return lineFigure(data, template, {
+                title: 'API Cost Over Time',
+                yaxisTitle: 'Cost ($)',
+                name: 'API Cost',
+                color: '#ff6b6b',
+                fillcolor: 'rgba(255, 107, 107, 0.1)'
+            });
+        },
+
+        renderRateLimit: function(data, template) {
+            return lineFigure(data, template, {
+                title: 'Rate Limit Usage',
+                yaxisTitle: 'Remaining Quota (%)',
+                name: 'Remaining Quota',
+                color: '#4cc9f0',
+                fillcolor: 'rgba(76, 201, 240, 0.1)'
+            });
+        },
+
+        renderActivityHeatmap: function(data, template) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+
+            return {
+                data: [{
+                    type: 'heatmap',
+                    z: data.z,
+                    x: DAYS,
+                    y: HOURS,
+                    colorscale: 'Viridis',
+                    showscale: true
+                }],
+                layout: chartLayout(template, 'User Activity Heatmap', 'Day of Week', 'Hour of Day')
+            };
+        }
+    }
+});
@@ -1,12 +1,15 @@
 import redis
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
 import os
+import json
 from dotenv import load_dotenv
 import time
 import random
 from datetime import datetime, timedelta
 import threading
 import logging
+import signal
 
 # Configure logging
 logging.basicConfig(
@@ -18,6 +21,34 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Channel the dashboard subscribes to for real-time stat updates
+STATS_CHANNEL = 'chatbot_dashboard:stats'
+
+# Seconds between collector ticks
+COLLECT_INTERVAL = 5
+
+# Collector ticks buffered before records are flushed to MongoDB
+FLUSH_TICKS = 12
+
+# Most records kept per collection while MongoDB is unavailable (one hour)
+MAX_PENDING = 60 * FLUSH_TICKS
+
+# MongoDB error codes
+DUPLICATE_KEY = 11000
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# Seconds of history kept in MongoDB; the dashboard only shows the last 24h
+RETENTION_SECONDS = 2 * 24 * 60 * 60
+
+def hourly_table(off_hours, business_hours, evening_peak):
+    # Per-hour lookup table: business hours 9-17, evening peak 18-22, off hours otherwise
+    table = [off_hours] * 24
+    table[9:18] = [business_hours] * 9
+    table[18:23] = [evening_peak] * 5
+    return tuple(table)
+
 class AnalyticsCollector:
     def __init__(self):
         # Initialize Redis connection
@@ -28,159 +59,351 @@ class AnalyticsCollector:
         )
         
         # Initialize MongoDB connection
-        self.mongo_client = MongoClient(os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'))
+        self.mongo_client = MongoClient(
+            os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'),
+            compressors='zstd,zlib'
+        )
         self.db = self.mongo_client['chatbot_analytics']
         
-        # Initialize counters
-        self.message_count = 0
-        self.active_users = 1
-        self.api_cost = 0.10
-        self.rate_limit = 100
+        # Index timestamps so the dashboard's 24h range queries avoid collection
+        # scans, expiring old records so the collections stay small
+        for collection in ['message_logs', 'user_activity', 'api_costs', 'rate_limits']:
+            self.ensure_ttl_index(collection, 'timestamp')
         
-        # Start background threads
-        self.start_collectors()
-    
-    def start_collectors(self):
-        # Start message collector
-        threading.Thread(target=self.collect_messages, daemon=True).start()
+        # Rolling hour x day activity counts read by the dashboard heatmap
+        self.db.heatmap_counts.create_index([('d', 1), ('h', 1)], unique=True)
+        self.db.heatmap_counts.create_index([('hour_start', 1)])
+        
+        # Per-minute message rollups read by the dashboard volume chart
+        self.ensure_ttl_index('stats_minute', 't', unique=True)
+        
+        # Whether a change stream maintains the message rollups (set in run())
+        self.watching = False
         
-        # Start user activity collector
-        threading.Thread(target=self.collect_user_activity, daemon=True).start()
+        # Records waiting to be flushed to MongoDB, by collection
+        self.pending = {
+            'message_logs': [],
+            'user_activity': [],
+            'api_costs': [],
+            'rate_limits': []
+        }
         
-        # Start API cost collector
-        threading.Thread(target=self.collect_api_costs, daemon=True).start()
+        # Initialize counters (message and cost totals live in Redis)
+        self.active_users = 1
+        self.rate_limit = 100
         
-        # Start rate limit collector
-        threading.Thread(target=self.collect_rate_limits, daemon=True).start()
+        # Simulation parameters by hour of day
+        self.message_ranges = hourly_table((0, 5), (5, 15), (8, 20))
+        self.base_users = hourly_table(10, 20, 30)
+        self.cost_ranges = hourly_table((0.02, 0.08), (0.05, 0.15), (0.08, 0.20))
+        self.rate_ranges = hourly_table((0, 2), (-3, 1), (-5, 0))
     
-    def collect_messages(self):
-        while True:
-            try:
-                # Simulate message volume with realistic patterns
-                hour = datetime.now().hour
-                if 9 <= hour <= 17:  # Business hours
-                    messages = random.randint(5, 15)
-                elif 18 <= hour <= 22:  # Evening peak
-                    messages = random.randint(8, 20)
-                else:  # Off hours
-                    messages = random.randint(0, 5)
-                
-                self.message_count += messages
-                
-                # Store in Redis
-                self.redis_client.set('total_messages', self.message_count)
-                
-                # Store in MongoDB
-                self.db.message_logs.insert_one({
-                    'timestamp': datetime.now(),
-                    'count': messages
-                })
-                
-                logger.info(f"Collected {messages} new messages")
-                time.sleep(5)
-            except Exception as e:
-                logger.error(f"Error in message collector: {e}")
-                time.sleep(5)
+    def ensure_ttl_index(self, collection, field, **options):
+        try:
+            self.db[collection].create_index(
+                [(field, 1)], expireAfterSeconds=RETENTION_SECONDS, **options
+            )
+        except OperationFailure as e:
+            if e.code not in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+                raise
+            # An index on the field already exists without the TTL; add it in place
+            self.db.command('collMod', collection, index={
+                'keyPattern': {field: 1},
+                'expireAfterSeconds': RETENTION_SECONDS
+            })
     
-    def collect_user_activity(self):
+    def run(self):
+        # Keep the message rollups current alongside the collector
+        self.start_message_rollups()
+        
+        # Run every collector tick on the calling thread at a fixed rate,
+        # so time spent in a tick doesn't push the next one back
+        next_tick = time.monotonic()
         while True:
+            self.collect()
+            next_tick = max(next_tick + COLLECT_INTERVAL, time.monotonic())
+            time.sleep(max(0, next_tick - time.monotonic()))
+    
+    def collect(self):
+        try:
+            # Capture the tick time once so all records share it
+            now = datetime.now()
+            messages = self.simulate_messages(now)
+            self.simulate_user_activity(now)
+            cost_increment = self.simulate_api_costs(now)
+            self.simulate_rate_limits(now)
+            
+            # Store in Redis in a single round-trip, accumulating totals server-side
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.incrby('total_messages', messages)
+            pipe.set('active_users', self.active_users)
+            pipe.incrbyfloat('api_cost', cost_increment)
+            pipe.set('rate_limit', self.rate_limit)
+            total_messages, _, api_cost, _ = pipe.execute()
+            
+            # Notify the dashboard
+            self.redis_client.publish(STATS_CHANNEL, json.dumps({
+                'total_messages': total_messages,
+                'active_users': self.active_users,
+                'api_cost': api_cost,
+                'rate_limit': self.rate_limit
+            }))
+            
+            # Buffer records for MongoDB, flushing them in batches
+            self.buffer('message_logs', {
+                'timestamp': now,
+                'count': messages
+            })
+            self.buffer('user_activity', {
+                'timestamp': now,
+                'count': self.active_users
+            })
+            self.buffer('api_costs', {
+                'timestamp': now,
+                'cost': api_cost
+            })
+            self.buffer('rate_limits', {
+                'timestamp': now,
+                'remaining': self.rate_limit
+            })
+            
+            # A failed heatmap update must not hold up the flush
             try:
-                # Simulate user activity with realistic patterns
-                hour = datetime.now().hour
-                day = datetime.now().weekday()
-                
-                # Base users based on time of day
-                if 9 <= hour <= 17:  # Business hours
-                    base_users = 20
-                elif 18 <= hour <= 22:  # Evening peak
-                    base_users = 30
-                else:  # Off hours
-                    base_users = 10
-                
-                # Adjust for weekends
-                if day >= 5:  # Weekend
-                    base_users = int(base_users * 0.7)
-                
-                # Add some randomness
-                self.active_users = base_users + random.randint(-5, 5)
-                
-                # Store in Redis
-                self.redis_client.set('active_users', self.active_users)
-                
-                # Store in MongoDB
-                self.db.user_activity.insert_one({
-                    'timestamp': datetime.now(),
-                    'count': self.active_users
-                })
-                
-                logger.info(f"Active users: {self.active_users}")
-                time.sleep(5)
-            except Exception as e:
-                logger.error(f"Error in user activity collector: {e}")
-                time.sleep(5)
+                self.update_heatmap_counts(now)
+            except PyMongoError as e:
+                logger.error(f"Error updating heatmap counts: {e}")
+            
+            if len(self.pending['message_logs']) >= FLUSH_TICKS:
+                self.flush()
+            
+            logger.info(
+                f"Collected {messages} new messages, "
+                f"active users: {self.active_users}, "
+                f"API cost: ${api_cost:.2f}, "
+                f"rate limit: {self.rate_limit}%"
+            )
+        except Exception as e:
+            logger.error(f"Error in collector: {e}")
     
-    def collect_api_costs(self):
-        while True:
+    def flush(self):
+        # Write buffered records with one insert_many per collection
+        for collection in self.pending:
+            records, self.pending[collection] = self.pending[collection], []
+            if not records:
+                continue
+            stored = records
             try:
-                # Simulate API costs with realistic patterns
-                hour = datetime.now().hour
-                if 9 <= hour <= 17:  # Business hours
-                    cost_increment = random.uniform(0.05, 0.15)
-                elif 18 <= hour <= 22:  # Evening peak
-                    cost_increment = random.uniform(0.08, 0.20)
-                else:  # Off hours
-                    cost_increment = random.uniform(0.02, 0.08)
-                
-                self.api_cost += cost_increment
-                
-                # Store in Redis
-                self.redis_client.set('api_cost', self.api_cost)
-                
-                # Store in MongoDB
-                self.db.api_costs.insert_one({
-                    'timestamp': datetime.now(),
-                    'cost': self.api_cost
-                })
-                
-                logger.info(f"API cost: ${self.api_cost:.2f}")
-                time.sleep(5)
-            except Exception as e:
-                logger.error(f"Error in API cost collector: {e}")
-                time.sleep(5)
+                self.db[collection].insert_many(records, ordered=False)
+            except BulkWriteError as e:
+                # Records rejected as duplicates were stored by an earlier
+                # attempt (insert_many sets their _id); retry only the rest
+                failed_indexes = {
+                    error['index']
+                    for error in e.details['writeErrors']
+                    if error['code'] != DUPLICATE_KEY
+                }
+                stored = [r for i, r in enumerate(records) if i not in failed_indexes]
+                if failed_indexes:
+                    logger.error(f"Failed to write {len(failed_indexes)} {collection} records: {e}")
+                    self.requeue(collection, [records[i] for i in sorted(failed_indexes)])
+            except PyMongoError as e:
+                logger.error(f"Error flushing {collection}: {e}")
+                self.requeue(collection, records)
+                stored = []
+            except BaseException:
+                # Interrupted (e.g. SIGTERM) mid-insert; keep the batch for the
+                # final flush, which drops anything already stored as a duplicate
+                self.requeue(collection, records)
+                raise
+            
+            # Without a change stream, roll message logs up as they are stored
+            if collection == 'message_logs' and stored and not self.watching:
+                try:
+                    self.rollup_messages(stored)
+                except PyMongoError as e:
+                    logger.error(f"Error rolling up message logs: {e}")
+    
+    def buffer(self, collection, record):
+        self.pending[collection].append(record)
+        self.trim(collection)
+    
+    def requeue(self, collection, records):
+        # Put records back ahead of newer ones
+        self.pending[collection] = records + self.pending[collection]
+        self.trim(collection)
+    
+    def trim(self, collection):
+        # Drop the oldest records past the cap while MongoDB is unavailable
+        pending = self.pending[collection]
+        if len(pending) > MAX_PENDING:
+            logger.warning(f"Dropping {len(pending) - MAX_PENDING} unflushed {collection} records")
+            self.pending[collection] = pending[-MAX_PENDING:]
+    
+    def start_message_rollups(self):
+        # Change streams need a replica set or sharded cluster; on a standalone
+        # server the message logs are rolled up as they are flushed instead
+        hello = self.db.command('hello')
+        self.watching = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+        
+        if self.watching:
+            stream = self.open_message_stream(self.load_resume_token())
+            threading.Thread(
+                target=self.watch_message_logs, args=(stream,), daemon=True
+            ).start()
+        else:
+            logger.warning("MongoDB is not a replica set; rolling up message logs on flush")
+            self.backfill_message_rollups()
+    
+    def load_resume_token(self):
+        state = self.db.collector_state.find_one({'_id': 'message_logs_watch'})
+        return state['resume_token'] if state else None
+    
+    def open_message_stream(self, resume_token):
+        # The stream is opened before any backfill, so logs inserted while the
+        # backfill runs are still delivered by it
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        try:
+            stream = self.db.message_logs.watch(pipeline, resume_after=resume_token)
+        except OperationFailure as e:
+            if resume_token is None or e.code != CHANGE_STREAM_HISTORY_LOST:
+                raise
+            # The oplog no longer reaches the saved token; start over
+            logger.warning("Message log change stream history lost; rebuilding rollups")
+            self.db.collector_state.delete_one({'_id': 'message_logs_watch'})
+            resume_token = None
+            stream = self.db.message_logs.watch(pipeline)
+        
+        if resume_token is None:
+            self.backfill_message_rollups()
+        return stream
+    
+    def backfill_message_rollups(self):
+        # Rebuild the last 24h of per-minute rollups from the raw message logs
+        start_time = (datetime.now() - timedelta(hours=24)).replace(second=0, microsecond=0)
+        self.rebuild_message_rollups(start_time)
+    
+    def rebuild_message_rollups(self, start_time, end_time=None):
+        # Recompute the per-minute totals in [start_time, end_time) from the raw
+        # logs. Rebuilding rather than incrementing makes replayed change events
+        # and several collectors watching the same logs harmless.
+        timestamp_range = {'$gte': start_time}
+        if end_time is not None:
+            timestamp_range['$lt'] = end_time
+        self.db.message_logs.aggregate([
+            {
+                '$match': {'timestamp': timestamp_range}
+            },
+            {
+                '$group': {
+                    '_id': {'$dateTrunc': {'date': '$timestamp', 'unit': 'minute'}},
+                    'count': {'$sum': '$count'}
+                }
+            },
+            {
+                '$project': {'_id': 0, 't': '$_id', 'count': 1}
+            },
+            {
+                '$merge': {
+                    'into': 'stats_minute',
+                    'on': 't',
+                    'whenMatched': 'replace',
+                    'whenNotMatched': 'insert'
+                }
+            }
+        ])
     
-    def collect_rate_limits(self):
+    def rollup_messages(self, logs):
+        # Rebuild the minutes covered by the given message logs
+        minutes = [log['timestamp'].replace(second=0, microsecond=0) for log in logs]
+        self.rebuild_message_rollups(min(minutes), max(minutes) + timedelta(minutes=1))
+    
+    def watch_message_logs(self, stream):
+        # Keep the per-minute rollups current from inserted message logs, saving
+        # the resume token so inserts made while the collector is down are caught up
+        history_lost = False
         while True:
             try:
-                # Simulate rate limit usage with realistic patterns
-                hour = datetime.now().hour
-                if 9 <= hour <= 17:  # Business hours
-                    rate_change = random.randint(-3, 1)
-                elif 18 <= hour <= 22:  # Evening peak
-                    rate_change = random.randint(-5, 0)
-                else:  # Off hours
-                    rate_change = random.randint(0, 2)
-                
-                self.rate_limit = max(80, min(100, self.rate_limit + rate_change))
-                
-                # Store in Redis
-                self.redis_client.set('rate_limit', self.rate_limit)
-                
-                # Store in MongoDB
-                self.db.rate_limits.insert_one({
-                    'timestamp': datetime.now(),
-                    'remaining': self.rate_limit
-                })
-                
-                logger.info(f"Rate limit: {self.rate_limit}%")
-                time.sleep(5)
+                if stream is None:
+                    # Reopening without a token rebuilds the rollups
+                    resume_token = None if history_lost else self.load_resume_token()
+                    stream = self.open_message_stream(resume_token)
+                    history_lost = False
+                with stream:
+                    for change in stream:
+                        self.rollup_messages([change['fullDocument']])
+                        self.db.collector_state.update_one(
+                            {'_id': 'message_logs_watch'},
+                            {'$set': {'resume_token': stream.resume_token}},
+                            upsert=True
+                        )
+            except OperationFailure as e:
+                logger.error(f"Error in message log watcher: {e}")
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    history_lost = True
+                else:
+                    time.sleep(5)
             except Exception as e:
-                logger.error(f"Error in rate limit collector: {e}")
+                logger.error(f"Error in message log watcher: {e}")
                 time.sleep(5)
+            stream = None
+    
+    def update_heatmap_counts(self, now):
+        # Accumulate active users into the current (day, hour) cell,
+        # restarting the cell when a new week reaches it
+        hour_start = now.replace(minute=0, second=0, microsecond=0)
+        self.db.heatmap_counts.update_one(
+            {'d': now.isoweekday(), 'h': now.hour},
+            [{
+                '$set': {
+                    'count': {
+                        '$cond': [
+                            {'$eq': ['$hour_start', hour_start]},
+                            {'$add': ['$count', self.active_users]},
+                            self.active_users
+                        ]
+                    },
+                    'hour_start': hour_start
+                }
+            }],
+            upsert=True
+        )
+    
+    def simulate_messages(self, now):
+        # Simulate message volume with realistic patterns
+        low, high = self.message_ranges[now.hour]
+        return random.randint(low, high)
+    
+    def simulate_user_activity(self, now):
+        # Simulate user activity with realistic patterns
+        base_users = self.base_users[now.hour]
+        
+        # Adjust for weekends
+        if now.weekday() >= 5:  # Weekend
+            base_users = int(base_users * 0.7)
+        
+        # Add some randomness
+        self.active_users = base_users + random.randint(-5, 5)
+    
+    def simulate_api_costs(self, now):
+        # Simulate API costs with realistic patterns
+        low, high = self.cost_ranges[now.hour]
+        return random.uniform(low, high)
+    
+    def simulate_rate_limits(self, now):
+        # Simulate rate limit usage with realistic patterns
+        low, high = self.rate_ranges[now.hour]
+        rate_change = random.randint(low, high)
+        
+        self.rate_limit = max(80, min(100, self.rate_limit + rate_change))
 
 if __name__ == '__main__':
+    # Stop on SIGTERM the same way as on Ctrl+C, so buffered records are flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    
     collector = AnalyticsCollector()
     try:
-        while True:
-            time.sleep(1)
+        collector.run()
     except KeyboardInterrupt:
-        logger.info("Stopping data collector...") 
\ No newline at end of file
+        logger.info("Stopping data collector...")
+    finally:
+        collector.flush() 
\ No newline at end of file